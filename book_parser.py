@@ -1,15 +1,45 @@
 import os
-from time import sleep
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from pathlib import Path
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlsplit
+from lxml import html as lxml_html
+from lxml.etree import ParserError, XPath
 import argparse
 import logging
+import threading
 
 logger = logging.getLogger('logger')
 
+BOOKS_WORKERS = 8
+REQUESTS_WORKERS = 8
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']), raise_on_status=False),
+    pool_connections=1, pool_maxsize=BOOKS_WORKERS + REQUESTS_WORKERS,
+))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 1 << 20
+WRITE_BATCH_MAX_CHUNKS = 64
+SITE_URL = 'https://tululu.org'
+MAIN_PAGE_URL = f'{SITE_URL}/'
+FORBIDDEN_FILENAME_CHARS = str.maketrans({char: '_' for char in '<>:"/\\|?*'})
+
+HTML_PARSERS = threading.local()
+
+BOOK_HEADER_XPATH = XPath('string(.//h1)')
+BOOK_IMG_XPATH = XPath('.//img/@src', smart_strings=False)
+BOOK_COMMENTS_XPATH = XPath('.//div[contains(concat(" ", normalize-space(@class), " "), " texts ")]')
+BOOK_GENRES_XPATH = XPath('(.//span[contains(concat(" ", normalize-space(@class), " "), " d_book ")])[1]//a')
+
 
 def set_cli_args():
     """
@@ -18,6 +48,7 @@ def set_cli_args():
     Args:
         - start_id (-s или --start_id): нижняя граница диапазона скачиваемых книг (натуральное число).
         - end_id (-e или --end_id): верхняя граница диапазона скачиваемых книг (натуральное число).
+        - durable (--durable): сбрасывать каждый файл на диск (fsync).
 
     Returns:
         argparse.Namespace: Объект с разобранными аргументами командной строки.
@@ -39,10 +70,12 @@ def set_cli_args():
                         help='нижняя граница диапазона скачиваемых книг (натуральное число)')
     parser.add_argument('-e', '--end_id', type=int, required=True,
                         help='верхняя граница диапазона скачиваемых книг (натуральное число).')
+    parser.add_argument('--durable', action='store_true',
+                        help='сбрасывать каждый файл на диск (fsync), чтобы он пережил сбой системы')
     return parser
 
 
-def request_for_book(url, params: dict, log_message: str):
+def request_for_book(url, params: dict, log_message: str, stream: bool = False):
     """
     Выполняет HTTP-запрос к странице книги по заданному идентификатору книги.
 
@@ -54,6 +87,7 @@ def request_for_book(url, params: dict, log_message: str):
         url (str): Ардес страницы для запроса
         params (dict): Параметры для запроса скачивания текста книги
         log_message (str): Текст для информационного сообщения о том, что отправлен запрос
+        stream (bool): Не загружать тело ответа сразу, а читать его частями по мере записи на диск
 
     Returns:
         requests.Response: Ответ сервера на HTTP-запрос.
@@ -67,12 +101,43 @@ def request_for_book(url, params: dict, log_message: str):
         >>> response.status_code
         200
     """
-    book_response = requests.get(url, allow_redirects=False, timeout=3, params=params)
-    book_response.raise_for_status()
+    book_response = SESSION.get(url, allow_redirects=False, timeout=3, params=params, stream=stream)
+    try:
+        book_response.raise_for_status()
+    except requests.HTTPError:
+        book_response.close()
+        raise
     logger.info(log_message)
     return book_response
 
 
+def close_response_future(response_future):
+    """
+    Закрывает ответ, полученный в фоновом запросе, если запрос завершился успешно.
+
+    Нужно, чтобы соединение ответа, запрошенного с stream=True, вернулось в пул сессии,
+    когда сам ответ уже не понадобится.
+
+    Args:
+        response_future (concurrent.futures.Future): Фоновый запрос, возвращающий requests.Response.
+    """
+    if not response_future.exception():
+        response_future.result().close()
+
+
+def is_available(response) -> bool:
+    """
+    Проверяет, что в ответ на запрос пришла сама страница, а не редирект.
+
+    Args:
+        response (requests.Response): Объект ответа HTTP.
+
+    Returns:
+        bool: False, если статус код ответа указывает на редирект (300-399), иначе True.
+    """
+    return not (300 <= response.status_code < 400)
+
+
 def check_for_redirect(response, book_error: str):
     """
     Проверяет, произошел ли редирект для данного ответа.
@@ -86,44 +151,172 @@ def check_for_redirect(response, book_error: str):
     Raises:
         Custom Error если по id не найдена страница книги или на странице книги не доступен файл текста книги для скачивания
     """
-    if response.is_redirect:
+    if not is_available(response):
         raise ValueError(book_error)
 
 
+def get_html_parser(encoding):
+    """
+    Возвращает парсер HTML для заданной кодировки, созданный один раз в текущем потоке.
+
+    Парсеры lxml не работают в нескольких потоках одновременно, поэтому у каждого потока свои.
+
+    Args:
+        encoding (str | None): Кодировка страницы или None, чтобы lxml определил ее сам.
+
+    Returns:
+        lxml.html.HTMLParser: Парсер HTML.
+    """
+    if not hasattr(HTML_PARSERS, 'by_encoding'):
+        HTML_PARSERS.by_encoding = {}
+    if encoding not in HTML_PARSERS.by_encoding:
+        HTML_PARSERS.by_encoding[encoding] = lxml_html.HTMLParser(encoding=encoding)
+    return HTML_PARSERS.by_encoding[encoding]
+
+
 def extract_book_details(book_response, book_id: int) -> dict:
     """
     Собирает данные о книге из HTML-ответа в словарь.
 
+    Кодировка берется из заголовка Content-Type, только если он ее явно указывает,
+    иначе lxml определяет ее сам по <meta charset> страницы.
+
     Args:
         book_response (requests.Response): HTTP-ответ с данными о книге.
         book_id (int): Идентификатор книги.
-        base_url (str): Базовый URL для формирования полного пути к изображению.
 
     Returns:
         dict: Словарь с данными о книге.
+
+    Raises:
+        LookupError: Если на странице нет нужного блока или он другого вида.
+        lxml.etree.ParserError: Если страница пустая.
     """
-    soup = BeautifulSoup(book_response.text, 'lxml')
+    content_type = book_response.headers.get('Content-Type', '').lower()
+    encoding = book_response.encoding if 'charset=' in content_type else None
+    page = lxml_html.fromstring(book_response.content, parser=get_html_parser(encoding))
+    content = page.get_element_by_id('content')
 
-    book_header = soup.find(id='content').find('h1').text.split('\xa0')
+    book_header = BOOK_HEADER_XPATH(content).split('\xa0')
+    img_src = BOOK_IMG_XPATH(content)[0]
     book = {
         'id': book_id, 'title': book_header[0],
         'author': book_header[2],
-        'img': urljoin(book_response.url, soup.find(id='content').find('img')['src']),
-        'comments': [book_comment.text.split(')')[1] for book_comment in soup.find_all('div', class_='texts')],
-        'genres': [book_genre.text for book_genre in soup.find('span', class_='d_book').find_all('a')]
+        'img': img_src if img_src.startswith('http') else f'{SITE_URL}{img_src}',
+        'comments': [book_comment.text_content().split(')')[1] for book_comment in BOOK_COMMENTS_XPATH(content)],
+        'genres': [str(book_genre.text_content()) for book_genre in BOOK_GENRES_XPATH(content)]
     }
     return book
 
 
-def save_book_text(dir_name: Path, book_title: str, response, book_id: int) -> str:
+def write_chunks(fd: int, chunks: list):
+    """
+    Записывает куски данных в открытый файл одним системным вызовом writev.
+
+    Если система записала не все данные, остаток дописывается обычным write.
+    На платформах без writev (Windows) куски склеиваются и пишутся одним write.
+
+    Args:
+        fd (int): Дескриптор открытого на запись файла.
+        chunks (list): Список кусков данных (bytes).
+
+    Raises:
+        OSError: Если произошла ошибка при записи файла.
+    """
+    if not hasattr(os, 'writev'):
+        chunks = [b''.join(chunks)]
+        written = os.write(fd, chunks[0])
+    else:
+        written = os.writev(fd, chunks)
+    if written == sum(len(chunk) for chunk in chunks):
+        return
+    rest = memoryview(b''.join(chunks))[written:]
+    while rest:
+        rest = rest[os.write(fd, rest):]
+
+
+def fsync_dir(dir_name: Path):
+    """
+    Сбрасывает на диск содержимое директории, чтобы переименование файла в ней пережило сбой.
+
+    На Windows директорию нельзя открыть для fsync, там функция ничего не делает.
+
+    Args:
+        dir_name (Path): Директория, которую нужно сбросить на диск.
+
+    Raises:
+        OSError: Если не удалось открыть директорию или сбросить ее на диск.
+    """
+    if os.name != 'posix':
+        return
+    fd = os.open(dir_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_response(response, filename: Path, durable: bool = False):
+    """
+    Записывает тело HTTP-ответа в файл, собирая куски в пачки до WRITE_BUFFER_SIZE.
+
+    Каждая пачка уходит в файл одним вызовом writev прямо на дескриптор, без
+    промежуточного копирования в буфер Python.
+
+    Данные пишутся в отдельный для каждого вызова временный файл рядом с итоговым и только
+    затем переименовываются в итоговый, поэтому несколько потоков, скачивающих одну и ту же
+    обложку, не мешают друг другу. Если запись прервалась, временный файл удаляется, так что
+    недокачанный файл не остается.
+
+    В режиме durable временный файл перед переименованием сбрасывается на диск (fsync),
+    а после переименования на диск сбрасывается и директория с ним.
+
+    Args:
+        response (requests.Response): HTTP-ответ, тело которого нужно сохранить.
+        filename (Path): Путь к файлу.
+        durable (bool): Сбросить файл на диск (fsync).
+
+    Raises:
+        OSError: Если произошла ошибка при записи файла.
+    """
+    fd, path = tempfile.mkstemp(prefix=f'{filename.name}.', suffix='.tmp', dir=filename.parent)
+    try:
+        try:
+            batch, batch_size = [], 0
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                batch.append(chunk)
+                batch_size += len(chunk)
+                if batch_size >= WRITE_BUFFER_SIZE or len(batch) >= WRITE_BATCH_MAX_CHUNKS:
+                    write_chunks(fd, batch)
+                    batch, batch_size = [], 0
+            if batch:
+                write_chunks(fd, batch)
+            if durable:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.chmod(path, 0o644)
+        os.replace(path, filename)
+        if durable:
+            fsync_dir(filename.parent)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+        raise
+
+
+def save_book_text(dir_name: Path, book_title: str, response, book_id: int, durable: bool = False) -> str:
     """
     Сохраняет содержимое HTTP-ответа в файл.
 
+    Символы, недопустимые в именах файлов, в названии книги заменяются на '_'.
+
     Args:
-        dir_name (str): Директория для сохранения файла.
+        dir_name (Path): Директория для сохранения файла.
         book_title (str): Название книги.
         response (requests.Response): HTTP-ответ с содержимым книги.
         book_id (int): Идентификатор книги.
+        durable (bool): Сбросить файл на диск (fsync).
 
     Returns:
         str: Полный путь к сохраненному файлу.
@@ -131,20 +324,19 @@ def save_book_text(dir_name: Path, book_title: str, response, book_id: int) -> s
     Raises:
         OSError: Если произошла ошибка при записи файла.
     """
-    filename = f'{dir_name}/{book_id}. {book_title}.txt'
-    with open(filename, 'wb') as file:
-        file.write(response.content)
-    return filename
+    path = dir_name / f'{book_id}. {book_title.translate(FORBIDDEN_FILENAME_CHARS).strip()}.txt'
+    save_response(response, path, durable)
+    return str(path)
 
 
-def download_book_cover(book_img_url_path: str, dir_name: Path, book_image_full_url: str) -> str:
+def download_book_cover(dir_name: Path, book_image_full_url: str, durable: bool = False) -> str:
     """
     Загружает изображение обложки книги и сохраняет его в указанной директории.
 
     Args:
-        book_img_url_path (str): Относительный путь к изображению обложки книги.
-        dir_name (str): Директория для сохранения изображения.
+        dir_name (Path): Директория для сохранения изображения.
         book_image_full_url (str): Полный URL изображения обложки книги.
+        durable (bool): Сбросить файл на диск (fsync).
 
     Returns:
         str: Полный путь к сохраненному файлу.
@@ -153,12 +345,78 @@ def download_book_cover(book_img_url_path: str, dir_name: Path, book_image_full_
         requests.HTTPError: Если запрос на получение изображения завершился с ошибкой.
         OSError: Если произошла ошибка при записи файла.
     """
-    response = requests.get(book_image_full_url, timeout=3)
-    response.raise_for_status()
-    filename = os.path.join(dir_name, book_img_url_path.split('/')[2])
-    with open(filename, 'wb') as file:
-        file.write(response.content)
-    return filename
+    path = dir_name / book_image_full_url.rsplit('/', 1)[-1].translate(FORBIDDEN_FILENAME_CHARS)
+    with SESSION.get(book_image_full_url, timeout=3, stream=True) as response:
+        response.raise_for_status()
+        save_response(response, path, durable)
+    return str(path)
+
+
+def download_book(book_id: int, books_dir_name: Path, images_dir_name: Path, requests_executor: ThreadPoolExecutor,
+                  durable: bool = False):
+    """
+    Скачивает текст и обложку одной книги.
+
+    Запрос текста книги отправляется в requests_executor одновременно с запросом страницы книги.
+    Если страница или текст недоступны, страница не разбирается и обложка не скачивается.
+    Обложка скачивается в requests_executor, пока сохраняется текст.
+
+    Повторные попытки при сбоях сети и ошибках сервера выполняет сама сессия (см. SESSION),
+    если и они не помогли, ошибка записывается в лог.
+
+    Args:
+        book_id (int): Идентификатор книги.
+        books_dir_name (Path): Директория для сохранения текстов книг.
+        images_dir_name (Path): Директория для сохранения обложек книг.
+        requests_executor (ThreadPoolExecutor): Пул потоков для запросов текста и обложки книги.
+        durable (bool): Сбрасывать файлы на диск (fsync).
+
+    Returns:
+        dict | None: Словарь с данными о книге или None, если книгу скачать не удалось.
+    """
+    try:
+        book_download_future = requests_executor.submit(
+            request_for_book, url=f'{MAIN_PAGE_URL}txt.php', params={'id': book_id},
+            log_message='Запрос страницы скачивания текста книги', stream=True
+        )
+        try:
+            book_response = request_for_book(url=f'{MAIN_PAGE_URL}b{book_id}/', params=None,
+                                             log_message='Запрос страницы книги')
+        except Exception:
+            close_response_future(book_download_future)
+            raise
+        if not is_available(book_response):
+            close_response_future(book_download_future)
+            logger.error('Страница книги с данным id не найдена\n')
+            return None
+
+        with book_download_future.result() as book_download_response:
+            if not is_available(book_download_response):
+                logger.error('На странице данной книги недоступен файл текста для скачивания\n')
+                return None
+            book = extract_book_details(book_response, book_id)
+            cover_future = requests_executor.submit(download_book_cover, images_dir_name, book['img'], durable)
+            try:
+                save_book_text(books_dir_name, book['title'], book_download_response, book['id'], durable)
+            except BaseException:
+                if cover_future.exception():
+                    logger.error(f'Ошибка при скачивании обложки: {cover_future.exception()}')
+                raise
+        cover_future.result()
+        return book
+    except requests.HTTPError as error:
+        logger.error(f'Ошибка сервера: {error}')
+    except requests.ConnectionError:
+        logger.error('Ошибка подключения, проверьте доступ в интернет')
+    except requests.Timeout:
+        logger.error('Время ожидания ответа превышено')
+    except requests.RequestException as error:
+        logger.error(f'Ошибка при скачивании книги: {error}')
+    except OSError as error:
+        logger.error(f'Ошибка при записи файла: {error}')
+    except (LookupError, ParserError) as error:
+        logger.error(f'Не удалось разобрать страницу книги: {error!r}')
+    return None
 
 
 def main():
@@ -166,7 +424,8 @@ def main():
     Основная функция программы для скачивания книг и их обложек с сайта tululu.org.
 
     Функция создает необходимые директории, запрашивает информацию о книгах и скачивает их
-    вместе с обложками в указанные директории.
+    вместе с обложками в указанные директории. Книги скачиваются параллельно в несколько
+    потоков, сведения о них выводятся в порядке возрастания id.
     """
     logging.basicConfig(level=logging.ERROR)
     parser = set_cli_args()
@@ -175,36 +434,15 @@ def main():
     books_dir_name.mkdir(exist_ok=True)
     images_dir_name = Path('images')
     images_dir_name.mkdir(exist_ok=True)
-    first_book_id = cli_args.start_id
-    last_book_id = cli_args.end_id
-    main_page_url = 'https://tululu.org/'
-    for book_id in range(first_book_id, last_book_id + 1):
-        while True:
-            try:
-                book_response = request_for_book(url=f'{main_page_url}b{book_id}/', params=None,
-                                                 log_message='Запрос страницы книги')
-                check_for_redirect(book_response, 'Страница книги с данным id не найдена\n')
-                book = extract_book_details(book_response, book_id, book_response.url)
-
-                book_download_response = request_for_book(url=f'{main_page_url}txt.php', params={'id': book_id},
-                                                          log_message='Запрос страницы скачивания текста книги')
-                check_for_redirect(book_download_response,
-                                   'На странице данной книги недоступен файл текста для скачивания\n')
-                save_book_text(books_dir_name, book['title'], book_download_response, book['id'])
-
-                download_book_cover(urlsplit(book['img'])[2], images_dir_name, book['img'])
-
-                print(f"Название: {book['title']}\nАвтор: {book['author']}\n")
-                break
-            except requests.ConnectionError:
-                logger.error("Ошибка подключения, проверьте доступ в интернет")
-                sleep(3)
-            except requests.Timeout:
-                logger.error('Время ожидания ответа превышено')
-            except ValueError as error:
-                logger.error(error)
-                break
-            continue
+    book_ids = range(cli_args.start_id, cli_args.end_id + 1)
+    with SESSION, ThreadPoolExecutor(max_workers=REQUESTS_WORKERS) as requests_executor:
+        with ThreadPoolExecutor(max_workers=BOOKS_WORKERS) as executor:
+            books = executor.map(partial(download_book, books_dir_name=books_dir_name, images_dir_name=images_dir_name,
+                                         requests_executor=requests_executor, durable=cli_args.durable),
+                                 book_ids)
+            for book in books:
+                if book:
+                    print(f"Название: {book['title']}\nАвтор: {book['author']}\n")
 
 
 if __name__ == '__main__':